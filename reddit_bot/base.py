@@ -1,17 +1,62 @@
+import heapq
+import json
+import os
+import random
 import sys
 import logging
+import multiprocessing
 import time
 
-from itertools import cycle
+from logging.handlers import QueueHandler, QueueListener
+from operator import attrgetter
 
 from praw import Reddit
 from praw.errors import Forbidden, RateLimitExceeded, HTTPException
 from requests.exceptions import ConnectionError
 
+try:
+    import requests_cache
+except ImportError:  # optional, enables the on-disk HTTP cache
+    requests_cache = None
+
 
 logger = logging.getLogger(__name__)
 
 
+# raw_json=1 makes Reddit skip HTML-escaping response bodies: smaller
+# payloads and no unescaping work on our side. PRAW only forwards
+# per-call params, so this has to be merged into each request.
+RAW_JSON_PARAMS = {'raw_json': 1}
+
+
+def _http_cache_filter(response):
+    # only about pages are safe to cache: listings must stay
+    # fresh or the `before` polling would never see new things
+    return '/about' in response.url
+
+
+if requests_cache is not None:
+    from praw.handlers import DefaultHandler
+
+    class _CachedHandler(DefaultHandler):
+        """DefaultHandler whose session caches about pages on disk.
+
+        PRAW dispatches requests through its handler's session, not
+        through `r.http` (direct requests there even raise
+        ClientException), so the cache has to be mounted here to see
+        any traffic.
+        """
+        def __init__(self, cache_name, expire_after):
+            super(_CachedHandler, self).__init__()
+            self.http = requests_cache.CachedSession(
+                cache_name,
+                backend='sqlite',
+                expire_after=expire_after,
+                allowable_methods=('GET',),
+                filter_fn=_http_cache_filter,
+            )
+
+
 DEFAULT_SETTINGS = {
     'loop_sleep': 2,
     'check_mail': 60,
@@ -24,6 +69,8 @@ DEFAULT_SETTINGS = {
     'max_replies_per_post': 3,
     'subreddit_timeout': 1800,
     'wait_after_reply': 60,
+    'idle_poll_max': 300,
+    'http_cache_ttl': 300,
 }
 
 
@@ -47,8 +94,7 @@ class _RedditBotBase(object):
 
     def bot_error(self, exception):
         """Bot got an unexpected exception."""
-        # TODO print stacktrace and context variables
-        sys.stderr.write('{!r}'.format(exception))
+        logger.error('Unexpected error', exc_info=exception)
 
     def loop(self, subreddit):
         """Looping over this subreddit now.
@@ -58,6 +104,15 @@ class _RedditBotBase(object):
         """
         pass
 
+    def loop_delay(self, subreddit, loop_sleep):
+        """Seconds until this subreddit should be polled again.
+
+        Subclasses that know when a subreddit becomes eligible again
+        (e.g. a reply timeout) can return a longer delay so the
+        scheduler skips it until then.
+        """
+        return loop_sleep
+
 
 class RedditBot(_RedditBotBase):
     """
@@ -67,21 +122,33 @@ class RedditBot(_RedditBotBase):
 
     """
     VERSION = (0, 0, 0)  # override this
+    _version_str = '0.0.0'
     USER_AGENT = '{name} v{version} (by /u/{admin})'
 
     # if loop() returns this the bot will refresh its settings
     BOT_SHOULD_REFRESH = 'BOT_SHOULD_REFRESH'
 
-    def __init__(self, config):
+    def __init_subclass__(cls, **kwargs):
+        """Precompute the dotted version string for the user agent."""
+        super().__init_subclass__(**kwargs)
+        cls._version_str = '.'.join(map(str, cls.VERSION))
+
+    def __init__(self, config, subreddit_shard=None):
         """
         Initialize the bot with a dict of configuration values.
 
+        :param tuple|None subreddit_shard: optional (index, total) pair
+            restricting this instance to every total-th subreddit,
+            used by `run_parallel`
+
         """
         self._setup(config)
         self._login(config)
 
+        self.subreddit_shard = subreddit_shard
         self.subreddits = self._get_subreddits()
         self.blocked_users = self._get_blocked_users()
+        self._rebuild_fast_lookups()
 
     def _setup(self, config):
         try:
@@ -89,12 +156,17 @@ class RedditBot(_RedditBotBase):
             if isinstance(admins, list):
                 self.admins = admins
             else:
-                self.admins = list(map(str.strip, admins.split(',')))
+                self.admins = [a.strip() for a in admins.split(',')]
 
             self.settings = DEFAULT_SETTINGS.copy()
             self.settings.update(config.get('settings', {}))
+            self._cache_settings()
+
+            self.subreddits_file = config.get('subreddit_list')
+            self.blocked_users_file = config.get('blocked_users')
+            self._file_cache = {}
+            self._force_refresh = bool(config.get('force_refresh'))
         except KeyError as e:
-            import sys
             sys.stderr.write('error: missing {} in configuration'.format(e))
             sys.exit(2)
 
@@ -102,26 +174,87 @@ class RedditBot(_RedditBotBase):
         logger.info('Attempting to login using OAuth2')
 
         for attr in ['client_id', 'client_secret', 'redirect_uri']:
-            assert attr in config['oauth_info'], 'Missing `{}` in oauth_info'.format(attr)
+            assert attr in config['oauth_info'], f'Missing `{attr}` in oauth_info'
+        client_id = config['oauth_info']['client_id']
 
-        self.r = Reddit('OAuth Login v1.0')
+        self.r = Reddit('OAuth Login v1.0',
+                        handler=self._make_http_cache_handler(client_id))
         self.r.set_oauth_app_info(**config['oauth_info'])
 
         for attr in ['access_token', 'refresh_token']:
-            assert attr in config['access_info'], 'Missing `{}` in access_info'.format(attr)
+            assert attr in config['access_info'], f'Missing `{attr}` in access_info'
         access_info = config['access_info']
         access_info['scope'] = self.__class__.get_scope()
+        cached_token = self._load_cached_token(client_id)
+        if cached_token:
+            logger.debug('Using cached access token')
+            access_info = dict(access_info, access_token=cached_token)
+
         self.r.set_access_credentials(**access_info)
+        if self.r.access_token != cached_token:
+            self._save_cached_token(client_id, self.r.access_token)
         self.bot_name = self.r.user.name
         self.admins.append(self.bot_name)
         user_agent = self.USER_AGENT.format(
             name=self.bot_name,
             admin=self.admins[0],
-            version='.'.join(map(str, self.VERSION))
+            version=self._version_str,
         )
-        logger.debug('User-Agent: {!r}'.format(user_agent))
+        logger.debug('User-Agent: %r', user_agent)
         self.r.http.headers['User-Agent'] = user_agent
-        logger.info('Logged in as {}'.format(self.bot_name))
+        logger.info('Logged in as %s', self.bot_name)
+
+    def _make_http_cache_handler(self, client_id):
+        """Build a praw handler that caches about pages on disk.
+
+        With requests-cache installed, GET responses for user and
+        subreddit about pages are kept in a sqlite file for
+        `http_cache_ttl` seconds. Duplicate lookups inside a poll
+        cycle then skip both the round trip and PRAW's rate-limit
+        sleep. Returns None (praw's stock handler) without the
+        package.
+        """
+        if requests_cache is None:
+            logger.debug('requests-cache not installed, HTTP cache disabled')
+            return None
+        filename = os.path.join(os.path.expanduser('~/.cache/reddit_bot'),
+                                '{}_http'.format(client_id))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return _CachedHandler(filename, self.settings['http_cache_ttl'])
+
+    # Reddit access tokens are valid for one hour
+    TOKEN_LIFETIME = 3600
+
+    def _token_cache_file(self, client_id):
+        return os.path.join(os.path.expanduser('~/.cache/reddit_bot'),
+                            '{}_token.json'.format(client_id))
+
+    def _load_cached_token(self, client_id):
+        """Return the access token from a previous run if still valid.
+
+        Reusing a fresh token skips the token refresh round trip that
+        would otherwise happen on every restart.
+        """
+        try:
+            with open(self._token_cache_file(client_id)) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cached.get('expires_at', 0) > time.time() + 60:
+            return cached.get('access_token')
+        return None
+
+    def _save_cached_token(self, client_id, access_token):
+        filename = self._token_cache_file(client_id)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w') as f:
+                json.dump({
+                    'access_token': access_token,
+                    'expires_at': time.time() + self.TOKEN_LIFETIME,
+                }, f)
+        except IOError as e:
+            logger.warning('Could not cache access token: %r', e)
 
     @classmethod
     def get_scope(cls):
@@ -144,61 +277,247 @@ class RedditBot(_RedditBotBase):
         finally:
             self.bot_stop()
 
+    @classmethod
+    def run_parallel(cls, config, num_workers):
+        """
+        Run the bot as `num_workers` processes, each handling every
+        num_workers-th subreddit with its own Reddit session.
+
+        Shards are disjoint, so the workers share no state beyond the
+        on-disk list caches, and each gets its own rate limit budget
+        when separate OAuth apps are configured.
+
+        """
+        # workers funnel their log records through one queue into the
+        # parent's handlers, so output is not interleaved mid-line
+        log_queue = multiprocessing.Queue()
+        listener = QueueListener(log_queue, *logging.getLogger().handlers)
+        listener.start()
+
+        workers = []
+        for index in range(num_workers):
+            worker = multiprocessing.Process(
+                target=cls._run_shard,
+                args=(config, index, num_workers, log_queue),
+                name='worker-{}'.format(index),
+            )
+            worker.start()
+            workers.append(worker)
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            listener.stop()
+
+    @classmethod
+    def _run_shard(cls, config, index, total, log_queue=None):
+        if log_queue is not None:
+            # replace any handlers inherited over fork, enqueueing a
+            # record is all the logging a worker does itself
+            root = logging.getLogger()
+            root.handlers = [QueueHandler(log_queue)]
+            root.setLevel(config.get('loglevel', 'WARN'))
+        bot = cls(config, subreddit_shard=(index, total))
+        bot.run_forever()
+
     def refresh(self):
         logger.info('Refreshing settings')
+        self._cache_settings()
+        session = getattr(self.r.handler, 'http', None)
+        cache = getattr(session, 'cache', None)
+        if cache is not None:
+            # blacklist and subreddit decisions should not be made
+            # from about pages older than the refresh
+            cache.clear()
         self.subreddits = self._get_subreddits()
         self.blocked_users = self._get_blocked_users()
+        self._rebuild_fast_lookups()
+
+    def _cache_settings(self):
+        """Copy hot-path settings into plain instance attributes.
+
+        A slotted-style attribute read is cheaper than the
+        `self.settings[...]` dict lookup the inner loops would
+        otherwise do per comment. Subclasses extend this with their
+        own hot settings; it runs at setup and on every refresh.
+        """
+        self._loop_sleep = self.settings['loop_sleep']
+
+    def _rebuild_fast_lookups(self):
+        """Rebuild the frozensets backing the hot membership checks.
+
+        The lists themselves only change through rare admin commands,
+        so the per-comment lookups can use immutable sets.
+        """
+        self._subreddits_fast = frozenset(self.subreddits)
+        self._blocked_users_fast = frozenset(self.blocked_users)
 
     def do_loop(self):
-        for subreddit in cycle(self.subreddits):
+        if not self.subreddits:
+            logger.error("No subreddits in file. Will read file again in 5 seconds.")
+            time.sleep(5)
+            return
+
+        # hoist the loop invariants, LOAD_FAST beats repeated
+        # LOAD_ATTR/dict lookups in this long-running loop
+        loop = self.loop
+        sleep = time.sleep
+        loop_sleep = self._loop_sleep
+        backoff_sleep = loop_sleep * 10
+        should_refresh = self.BOT_SHOULD_REFRESH
+
+        # min-heap of (next_ready, subreddit): only subreddits that
+        # are actually due get polled, instead of rotating over ones
+        # still inside their timeout. Random initial offsets spread
+        # rate-limit pressure the way the old shuffle did. Subreddits
+        # added by admin commands join the schedule on refresh.
+        now = time.monotonic()
+        schedule = [(now + random.uniform(0, loop_sleep), subreddit)
+                    for subreddit in self.subreddits]
+        heapq.heapify(schedule)
+
+        while schedule:
+            next_ready, subreddit = heapq.heappop(schedule)
+            now = time.monotonic()
+            if next_ready > now:
+                sleep(next_ready - now)
+            if subreddit not in self.subreddits:
+                # removed since it was scheduled, drop silently
+                continue
             try:
-                if self.loop(subreddit) == self.BOT_SHOULD_REFRESH:
-                    break
-            except Forbidden as e:
-                logger.error('Forbidden in {}! Removing from whitelist.'.format(subreddit))
+                if loop(subreddit) == should_refresh:
+                    return
+            except Forbidden:
+                logger.error('Forbidden in %s! Removing from whitelist.', subreddit)
                 self.remove_subreddits(subreddit)
-                break
+                continue
             except RateLimitExceeded as e:
-                logger.warning('RateLimitExceeded! Sleeping {} seconds.'.format(e.sleep_time))
-                time.sleep(e.sleep_time)
+                logger.warning('RateLimitExceeded! Sleeping %s seconds.', e.sleep_time)
+                sleep(e.sleep_time)
+                heapq.heappush(schedule,
+                               (time.monotonic() + loop_sleep, subreddit))
+                continue
             except (ConnectionError, HTTPException) as e:
-                logger.warning('Error: Reddit down or no connection? {!r}'.format(e))
-                time.sleep(self.settings['loop_sleep'] * 10)
-            else:
-                time.sleep(self.settings['loop_sleep'])
+                logger.warning('Error: Reddit down or no connection? %r', e)
+                heapq.heappush(schedule,
+                               (time.monotonic() + backoff_sleep, subreddit))
+                continue
+            delay = self.loop_delay(subreddit, loop_sleep)
+            heapq.heappush(schedule, (time.monotonic() + delay, subreddit))
+        # every subreddit was dropped; run_forever refreshes the lists
+
+    def _get_file_lines(self, filename):
+        """Read a set of names from a file, one entry per line.
+
+        The parsed set is cached per file and only re-read when the
+        file's mtime changes, so a refresh with an unchanged file does
+        no I/O beyond a stat call.
+        """
+        mtime = os.stat(filename).st_mtime
+        cached = self._file_cache.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        # read once as bytes and split, instead of allocating two str
+        # objects per line with readlines() + strip()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        stripped = (raw.strip() for raw in data.splitlines())
+        lines = {raw.decode('utf-8') for raw in stripped if raw}
+        self._file_cache[filename] = (mtime, lines)
+        return lines
+
+    def _list_cache_file(self, name):
+        return os.path.join(os.path.expanduser('~/.cache/reddit_bot'),
+                            '{}_{}.json'.format(self.bot_name, name))
+
+    def _cached_api_list(self, name, fetch):
+        """Return an API-backed list, served from a disk cache when fresh.
+
+        Paginating through get_my_subreddits/get_friends costs a burst
+        of API calls on every start and refresh. The result is cached
+        on disk and only refetched once it is subreddit_timeout seconds
+        old, the file is deleted, or --force-refresh was given.
+        """
+        filename = self._list_cache_file(name)
+        if self._force_refresh:
+            self._force_refresh = False
         else:
-            logger.error("No subreddits in file. Will read file again in 5 seconds.")
-            time.sleep(5)
+            try:
+                mtime = os.stat(filename).st_mtime
+                if time.time() - mtime < self.settings['subreddit_timeout']:
+                    with open(filename) as f:
+                        return set(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+        entries = set(fetch())
+        self._store_api_list(name, entries)
+        return entries
+
+    def _store_api_list(self, name, entries):
+        """Atomically write an API-backed list to its disk cache."""
+        filename = self._list_cache_file(name)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp = filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(sorted(entries), f)
+            os.replace(tmp, filename)
+        except IOError as e:
+            logger.warning('Could not cache %s list: %r', name, e)
 
     def _get_subreddits(self):
-        subreddits = list(map(lambda s: s.display_name, self.r.get_my_subreddits()))
-        logger.info('Subreddits: {} entries'.format(len(subreddits)))
-        logger.debug('List: {!r}'.format(subreddits))
+        if self.subreddits_file:
+            subreddits = self._get_file_lines(self.subreddits_file)
+        else:
+            subreddits = self._cached_api_list(
+                'subreddits',
+                lambda: map(attrgetter('display_name'),
+                            self.r.get_my_subreddits()))
+        if self.subreddit_shard is not None:
+            index, total = self.subreddit_shard
+            subreddits = sorted(subreddits)[index::total]
+        subreddits = set(subreddits)
+        logger.info('Subreddits: %d entries', len(subreddits))
+        logger.debug('List: %r', subreddits)
         return subreddits
 
     def _get_blocked_users(self, filename=None):
         """Friends are blocked users, because Reddit only allows blocking
         users by private messages."""
-        blocked_users = list(map(lambda u: u.name, self.r.get_friends()))
-        logger.info('Blocked users: {} entries'.format(len(blocked_users)))
-        logger.debug('List: {!r}'.format(blocked_users))
+        filename = filename or self.blocked_users_file
+        if filename:
+            blocked_users = set(self._get_file_lines(filename))
+        else:
+            blocked_users = self._cached_api_list(
+                'friends',
+                lambda: map(attrgetter('name'), self.r.get_friends()))
+        logger.info('Blocked users: %d entries', len(blocked_users))
+        logger.debug('List: %r', blocked_users)
         return blocked_users
 
     def is_user_blocked(self, user_name):
         if user_name == self.bot_name:
             return True
-        return user_name in self.blocked_users
+        return user_name in self._blocked_users_fast
 
     def is_subreddit_whitelisted(self, subreddit):
-        return subreddit in self.subreddits
+        return subreddit in self._subreddits_fast
 
     def remove_subreddits(self, *subreddits):
         for sub_name in subreddits:
             if sub_name in self.subreddits:
-                self.subreddits.remove(sub_name)
+                self.subreddits.discard(sub_name)
                 sub = self.r.get_subreddit(sub_name)
                 sub.unsubscribe()
-                logger.info('Unsubscribed from /r/{}'.format(sub_name))
+                logger.info('Unsubscribed from /r/%s', sub_name)
+        if not self.subreddits_file and self.subreddit_shard is None:
+            # a sharded worker only holds its slice of the whitelist;
+            # writing that back would clobber the full cached list
+            # shared with every other worker
+            self._store_api_list('subreddits', self.subreddits)
+        self._rebuild_fast_lookups()
 
     def add_subreddits(self, *subreddits):
         for sub_name in subreddits:
@@ -206,7 +525,11 @@ class RedditBot(_RedditBotBase):
                 self.subreddits.add(sub_name)
                 sub = self.r.get_subreddit(sub_name)
                 sub.subscribe()
-                logger.info('Subscribed to /r/{}'.format(sub_name))
+                logger.info('Subscribed to /r/%s', sub_name)
+        if not self.subreddits_file and self.subreddit_shard is None:
+            # see remove_subreddits: never persist a bare shard
+            self._store_api_list('subreddits', self.subreddits)
+        self._rebuild_fast_lookups()
 
     def block_users(self, *users):
         for user_name in users:
@@ -214,12 +537,18 @@ class RedditBot(_RedditBotBase):
                 self.blocked_users.add(user_name)
                 user = self.r.get_redditor(user_name)
                 user.friend()
-                logger.info('Blocked /u/{}'.format(user_name))
+                logger.info('Blocked /u/%s', user_name)
+        if not self.blocked_users_file:
+            self._store_api_list('friends', self.blocked_users)
+        self._rebuild_fast_lookups()
 
     def unblock_users(self, *users):
         for user_name in users:
             if user_name in self.blocked_users:
-                self.blocked_users.remove(user_name)
+                self.blocked_users.discard(user_name)
                 user = self.r.get_redditor(user_name)
                 user.unfriend()
-                logger.info('Unblocked /u/{}'.format(user_name))
+                logger.info('Unblocked /u/%s', user_name)
+        if not self.blocked_users_file:
+            self._store_api_list('friends', self.blocked_users)
+        self._rebuild_fast_lookups()
@@ -1,8 +1,7 @@
 import logging
+import time
 
-from datetime import datetime, timedelta
-
-from .base import RedditBot
+from .base import RAW_JSON_PARAMS, RedditBot
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +18,10 @@ class RedditMessageBot(RedditBot):
             'privatemessages',
         }
 
+    def _cache_settings(self):
+        super(RedditMessageBot, self)._cache_settings()
+        self._check_mail_seconds = float(self.settings['check_mail'])
+
     def bot_start(self):
         super(RedditMessageBot, self).bot_start()
 
@@ -30,22 +33,34 @@ class RedditMessageBot(RedditBot):
         self.check_mail_if_necessary()
 
     def check_mail_if_necessary(self):
-        delta = timedelta(seconds=self.settings['check_mail'])
-        if self.last_mail_check is None:
-            self.check_mail()
-        elif self.last_mail_check + delta < datetime.now():
+        last = self.last_mail_check
+        if last is None or time.monotonic() - last > self._check_mail_seconds:
             self.check_mail()
 
     def check_mail(self):
         logger.info('check_mail')
-        self.last_mail_check = datetime.now()
+        self.last_mail_check = time.monotonic()
 
-        if not self.r.get_me().has_mail:
+        # fetching the unread listing directly saves the get_me()
+        # round trip that was only made to look at has_mail
+        messages = list(self.r.get_unread(unset_has_mail=True,
+                                          params=dict(RAW_JSON_PARAMS)))
+        if not messages:
             return
 
         self.before_mail_check()
-        for message in self.r.get_unread(unset_has_mail=True):
-            self.on_message(message)
+        try:
+            for message in messages:
+                try:
+                    self.on_message(message)
+                except Exception as e:
+                    logger.error('on_message failed for %s',
+                                 message.fullname, exc_info=e)
+        finally:
+            # one bulk call instead of a POST per message; marking
+            # failed ones too keeps a poison message from being
+            # reprocessed on every mail check
+            self.r.user.mark_as_read(messages)
         self.after_mail_check()
 
     def before_mail_check(self):
@@ -61,13 +76,16 @@ class RedditMessageBot(RedditBot):
                 self.on_user_message(message.author.name, message)
 
     def on_subreddit_message(self, subreddit, message):
-        logger.info('{}.on_subreddit_message is not implemented.'.format(self.__class__.__name__))
+        logger.info('%s.on_subreddit_message is not implemented.',
+                    self.__class__.__name__)
 
     def on_admin_message(self, message):
-        logger.info('{}.on_admin_message is not implemented.'.format(self.__class__.__name__))
+        logger.info('%s.on_admin_message is not implemented.',
+                    self.__class__.__name__)
 
     def on_user_message(self, user, message):
-        logger.info('{}.on_user_message is not implemented'.format(self.__class__.__name__))
+        logger.info('%s.on_user_message is not implemented',
+                    self.__class__.__name__)
 
     def after_mail_check(self):
         pass
@@ -2,9 +2,11 @@
 
 import logging
 import json
+import queue
 import sys
 import os
 from importlib import import_module
+from logging.handlers import QueueHandler, QueueListener
 
 from praw import Reddit
 
@@ -110,15 +112,39 @@ def make_config(filename):
     return config
 
 
-def main(config_file):
+def setup_logging(loglevel):
+    """
+    Route log records through a queue to a background listener thread.
+
+    Logging from the bot's loop then only enqueues the record; the
+    listener thread does the actual formatting and stream I/O.
+
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(loglevel)
+    root.addHandler(QueueHandler(log_queue))
+    return listener
+
+
+def main(config_file, force_refresh=False):
     try:
-        with open(sys.argv[1]) as config_file:
-            logger.debug('loaded config from {}'.format(sys.argv[1]))
-            config = json.load(config_file)
+        with open(config_file) as f:
+            logger.debug('loaded config from %s', config_file)
+            config = json.load(f)
     except IOError:
-        config = make_config(sys.argv[1])
+        config = make_config(config_file)
 
-    logging.basicConfig(level=config.get('loglevel', 'WARN'), format=LOG_FORMAT)
+    if force_refresh:
+        config['force_refresh'] = True
+
+    listener = setup_logging(config.get('loglevel', 'WARN'))
 
     bot_class = get_bot_class(config['bot_class'])
     bot = bot_class(config)
@@ -127,16 +153,24 @@ def main(config_file):
         bot.run_forever()
     except KeyboardInterrupt:
         print('Goodbye!')
+    finally:
+        listener.stop()
 
 
 def run():
-    if len(sys.argv) != 2:
-        sys.stderr.write('Usage: {} <config_file>\n'.format(sys.argv[0]))
+    args = sys.argv[1:]
+    force_refresh = '--force-refresh' in args
+    if force_refresh:
+        args.remove('--force-refresh')
+
+    if len(args) != 1:
+        sys.stderr.write('Usage: {} [--force-refresh] <config_file>\n'.format(sys.argv[0]))
         sys.stderr.write('Will create <config_file> if it does not exist.\n')
+        sys.stderr.write('--force-refresh ignores the cached subreddit/friend lists.\n')
         sys.exit(1)
 
     run_path = os.getcwd()
     if run_path not in sys.path:
         sys.path.append(run_path)
 
-    main(sys.argv[1])
+    main(args[0], force_refresh=force_refresh)
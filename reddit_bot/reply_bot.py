@@ -1,19 +1,45 @@
+import heapq
 import logging
+import time
 
-from collections import Counter
-from datetime import datetime, timedelta
+from collections import OrderedDict
 
-from .base import RedditBot
+from .base import RAW_JSON_PARAMS, RedditBot
 
 
 logger = logging.getLogger(__name__)
 
 
+class _LRUCounter(OrderedDict):
+    """
+    A bounded counter that forgets its least recently used keys.
+
+    Missing (possibly evicted) keys count as zero, which at worst
+    allows a few extra replies to a submission old enough to have
+    been pushed out by `maxsize` newer ones.
+
+    """
+    def __init__(self, maxsize):
+        super(_LRUCounter, self).__init__()
+        self.maxsize = maxsize
+
+    def increment(self, key):
+        self[key] = self.get(key, 0) + 1
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
 class _RedditReplyBotMixin(object):
     """
     Keep track of how often we post in a subreddit.
 
     """
+    # consecutive empty fetches after which the before marker is
+    # dropped: if the marked thing gets deleted, Reddit returns an
+    # empty listing forever and the bot would go blind
+    EMPTY_FETCH_RESET = 5
+
     @classmethod
     def get_scope(cls):
         return super(_RedditReplyBotMixin, cls).get_scope() | {
@@ -25,54 +51,178 @@ class _RedditReplyBotMixin(object):
     def bot_start(self):
         super(_RedditReplyBotMixin, self).bot_start()
         self.subreddit_timeouts = {}
+        self._timeout_heap = []
+        self._poll_backoffs = {}
+        self._empty_fetches = {}
+        self._next_combined_poll = 0.0
+
+    def _cache_settings(self):
+        super(_RedditReplyBotMixin, self)._cache_settings()
+        self._fetch_limit = self.settings['fetch_limit']
+        self._max_age_seconds = float(self.settings['comment_max_age'])
+        self._subreddit_timeout_seconds = float(
+            self.settings['subreddit_timeout'])
+        self._idle_poll_max = float(self.settings['idle_poll_max'])
+        self._loop_delay_cap = float(self.settings['check_mail'])
 
     def _check_things(self, thing_type, subreddit, before=None):
         """
         Fetch latest things in a subreddit.
 
+        Polling with `before` makes Reddit skip already-delivered
+        things server-side, the same economy a streaming API would
+        give. PRAW 3's comment_stream helper blocks on one listing
+        forever, so it cannot drive a rotation that also serves other
+        subreddits and mail checks.
+
+        Things are yielded newest first, so callers record the first
+        fullname as their next `before` marker and can stop consuming
+        at any point without paying for further listing pages.
+
         :param 'comments'|'submissions' thing_type: what things to fetch
         :param str subreddit: name of the subreddit to check
         :param str|None before: latest thing id
 
         """
-        logger.debug('_check_things(subreddit={!r}, before={!r})'.format(
-            subreddit, before))
+        logger.debug('_check_things(subreddit=%r, before=%r)',
+                     subreddit, before)
 
-        params = {'sort': 'old', 'before': before}
-        latest_created = 0
-        latest_fullname = before
+        params = dict(RAW_JSON_PARAMS, before=before)
 
         if thing_type == 'submissions':
-            things = self.r.get_subreddit(subreddit).get_new(
-                limit=self.settings['fetch_limit'],
+            return self.r.get_subreddit(subreddit).get_new(
+                limit=self._fetch_limit,
                 params=params
             )
         elif thing_type == 'comments':
-            things = self.r.get_comments(
+            return self.r.get_comments(
                 subreddit,
-                limit=self.settings['fetch_limit'],
+                limit=self._fetch_limit,
                 params=params
             )
 
-        for thing in things:
-            if thing.created_utc > latest_created:
-                latest_created = thing.created_utc
-                latest_fullname = thing.fullname
-            yield 'thing', thing
-        # remember newest comment so we dont fetch it again
-        yield 'end', latest_fullname
-
     def can_post_in_subreddit(self, subreddit):
         """Check if we should post again in this subreddit."""
-        if subreddit not in self.subreddit_timeouts \
-           or self.subreddit_timeouts[subreddit] < datetime.now():
+        return self.subreddit_timeouts.get(subreddit, 0) < time.monotonic()
+
+    def _combined_subreddits(self):
+        """Combined listing path covering the whole whitelist.
+
+        Reddit accepts `/r/sub1+sub2+.../` paths, so one request can
+        scan every whitelisted subreddit at once.
+        """
+        return '+'.join(sorted(self.subreddits))
+
+    def _combined_fetch_due(self, listing):
+        """Decide whether the combined listing should be fetched now.
+
+        One fetch serves every scheduled `loop()` call in a loop_sleep
+        window, so the calls in between are no-ops. Skips the
+        fetch entirely while the idle backoff is active or every
+        subreddit is still inside its post timeout.
+        """
+        now = time.monotonic()
+        if now < self._next_combined_poll:
+            return False
+        if not self.should_poll_subreddit(listing):
+            return False
+        self._prune_expired_timeouts()
+        if self._timeout_heap \
+           and len(self.subreddit_timeouts) >= len(self.subreddits):
+            return False
+        self._next_combined_poll = now + self._loop_sleep
+        return True
+
+    def should_poll_subreddit(self, subreddit):
+        """Check whether an idle subreddit is due for another fetch."""
+        backoff = self._poll_backoffs.get(subreddit)
+        return backoff is None or backoff[0] <= time.monotonic()
+
+    def did_poll_subreddit(self, subreddit, found_new):
+        """Back off polling of subreddits that keep coming up empty.
+
+        Each empty fetch doubles the poll interval up to `idle_poll_max`
+        seconds; any new activity resets the subreddit to full speed.
+        This is how most of the request budget wasted on quiet
+        subreddits is recovered.
+        """
+        if found_new:
+            self._poll_backoffs.pop(subreddit, None)
+            return
+        backoff = self._poll_backoffs.get(subreddit)
+        if backoff is None:
+            delay = float(self._loop_sleep)
+        else:
+            delay = min(backoff[1] * 2, self._idle_poll_max)
+        self._poll_backoffs[subreddit] = (time.monotonic() + delay, delay)
+
+    def _before_marker_stale(self, listing, found_new):
+        """Detect a before marker that no longer matches anything.
+
+        When the marked thing is deleted, polling with `before`
+        returns an empty listing forever. After EMPTY_FETCH_RESET
+        consecutive empty fetches the marker is presumed dead and the
+        caller drops it, at the cost of one unfiltered fetch.
+        """
+        if found_new:
+            self._empty_fetches.pop(listing, None)
+            return False
+        count = self._empty_fetches.get(listing, 0) + 1
+        if count >= self.EMPTY_FETCH_RESET:
+            self._empty_fetches.pop(listing, None)
             return True
+        self._empty_fetches[listing] = count
         return False
 
     def did_post_in_subreddit(self, subreddit):
-        now = datetime.now()
-        delta = timedelta(seconds=self.settings['subreddit_timeout'])
-        self.subreddit_timeouts[subreddit] = now + delta
+        deadline = time.monotonic() + self._subreddit_timeout_seconds
+        self.subreddit_timeouts[subreddit] = deadline
+        heapq.heappush(self._timeout_heap, (deadline, subreddit))
+
+    def refresh(self):
+        super(_RedditReplyBotMixin, self).refresh()
+        # expired entries are popped lazily in _prune_expired_timeouts;
+        # this drops state for subreddits that left the whitelist, and the
+        # backoffs keyed by a now-outdated combined listing path
+        for subreddit in list(self.subreddit_timeouts):
+            if subreddit not in self.subreddits:
+                del self.subreddit_timeouts[subreddit]
+        self._timeout_heap = [
+            (deadline, subreddit)
+            for subreddit, deadline in self.subreddit_timeouts.items()
+        ]
+        heapq.heapify(self._timeout_heap)
+        self._poll_backoffs.clear()
+        self._empty_fetches.clear()
+
+    def _prune_expired_timeouts(self):
+        """Drop timeout entries whose deadline has passed.
+
+        Expired entries are popped lazily from the deadline heap;
+        stale heap entries left behind by a re-post are skipped by
+        comparing against the authoritative dict.
+        """
+        heap = self._timeout_heap
+        now = time.monotonic()
+        while heap and heap[0][0] <= now:
+            deadline, subreddit = heapq.heappop(heap)
+            if self.subreddit_timeouts.get(subreddit) == deadline:
+                del self.subreddit_timeouts[subreddit]
+
+    def loop_delay(self, subreddit, loop_sleep):
+        """Delay a subreddit that is still inside its reply timeout.
+
+        Polling it every loop_sleep seconds only burns cycles, so
+        the scheduler sleeps straight to the timeout expiry instead.
+        Capped at the mail check interval so periodic work is not
+        starved.
+        """
+        self._prune_expired_timeouts()
+        remaining = self.subreddit_timeouts.get(subreddit, 0) \
+            - time.monotonic()
+        if remaining > loop_sleep:
+            return min(remaining, self._loop_delay_cap)
+        return loop_sleep
 
 
 class RedditCommentBot(_RedditReplyBotMixin, RedditBot):
@@ -80,26 +230,75 @@ class RedditCommentBot(_RedditReplyBotMixin, RedditBot):
     A bot capable of replying to comments.
 
     """
+    # parents cached between passes; oldest entries are evicted first
+    PARENT_CACHE_SIZE = 2048
+    # comments already found invalid, so re-seen ones are rejected
+    # without re-running the checks (or the parent walk)
+    INVALID_CACHE_SIZE = 4096
+    # submissions tracked for the reply cap before old ones get evicted
+    SUBMISSION_COUNTER_SIZE = 10000
+
     def bot_start(self):
         super(RedditCommentBot, self).bot_start()
 
-        # TODO occasionally check size of this (with sys.getsizeof?) and clear
-        self.submissions_comment_counter = Counter()
+        self.submissions_comment_counter = _LRUCounter(
+            self.SUBMISSION_COUNTER_SIZE)
         self.subreddit_fullnames = {}
+        self._parent_cache = {}
+        self._invalid_comments = {}
         self.comment_checks = self.get_comment_checks()
 
         if self.settings['check_parent_comments']:
             self.comment_checks.append(self.comment_has_good_parents)
 
+        self.is_valid_comment = self._compile_comment_checks()
+
+    def _cache_settings(self):
+        super(RedditCommentBot, self)._cache_settings()
+        self._max_replies = self.settings['max_replies_per_post']
+        self._min_comment_score = self.settings['min_comment_score']
+        self._reply_if_score_hidden = self.settings['reply_if_score_hidden']
+        self._score_check_depth = self.settings['score_check_depth']
+
     def get_comment_checks(self):
         # TODO check score of actual submission
         # TODO do not reply to moderator comments
+        # Ordered cheapest first, so expensive checks only run on
+        # comments that passed everything else.
         return [
-            self.comment_is_new,
             self.comment_submission_cap_not_reached,
+            self.comment_is_new,
             self.comment_author_not_blacklisted,
         ]
 
+    def _compile_comment_checks(self):
+        """Bake `comment_checks` into a single short-circuiting function.
+
+        Avoids the `all()` generator and repeated attribute lookups
+        for every comment. Failed verdicts are remembered, so a
+        comment seen again across passes is rejected without redoing
+        the checks; only failures are cached because a stale pass
+        verdict could sidestep the reply cap. The negative cache is
+        dropped on refresh.
+        """
+        checks = tuple(self.comment_checks)
+
+        def is_valid_comment(comment, _checks=checks,
+                             _invalid=self._invalid_comments,
+                             _maxsize=self.INVALID_CACHE_SIZE):
+            comment_id = comment.id
+            if comment_id in _invalid:
+                return False
+            for check in _checks:
+                if not check(comment):
+                    _invalid[comment_id] = True
+                    if len(_invalid) > _maxsize:
+                        del _invalid[next(iter(_invalid))]
+                    return False
+            return True
+
+        return is_valid_comment
+
     def reply_comment(self, comment):
         """
         Implement the `reply_comment` method to reply to comments
@@ -115,72 +314,154 @@ class RedditCommentBot(_RedditReplyBotMixin, RedditBot):
     def loop(self, subreddit):
         super(RedditCommentBot, self).loop(subreddit)
 
-        if not self.can_post_in_subreddit(subreddit):
+        listing = self._combined_subreddits()
+        if not self._combined_fetch_due(listing):
             return
-        latest = self.subreddit_fullnames.get(subreddit, None)
-        self.check_comments(subreddit, before=latest)
-
-    def check_comments(self, subreddit, before=None):
-        """Fetch latest comments in a subreddit."""
-        for control, thing in self._check_things('comments', subreddit, before):
-            if control == 'end':
-                self.subreddit_fullnames[subreddit] = thing
-                break
+        latest = self.subreddit_fullnames.get(listing, None)
+        self.check_comments(listing, before=latest)
+
+    def check_comments(self, listing, before=None):
+        """Fetch latest comments from a (possibly combined) listing.
+
+        Each comment is dispatched against the per-subreddit timeouts,
+        so one request can serve replies to several subreddits.
+        """
+        comments = list(self._check_things('comments', listing, before))
+        # remember the newest comment so we dont fetch it again
+        latest = comments[0].fullname if comments else before
+        if self._before_marker_stale(listing, bool(comments)):
+            latest = None
 
-            comment = thing
+        self.did_poll_subreddit(listing, bool(comments))
 
+        # drop comments from subreddits still in timeout before the
+        # parent prefetch, their ancestors are not worth fetching
+        comments = [c for c in comments
+                    if self.can_post_in_subreddit(c.subreddit.display_name)]
+
+        if self.settings['check_parent_comments']:
+            self._prefetch_parents(comments)
+
+        for comment in comments:
+            subreddit = comment.subreddit.display_name
+            if not self.can_post_in_subreddit(subreddit):
+                continue
             if self.is_valid_comment(comment):
                 did_reply = self.reply_comment(comment)
                 if did_reply:
-                    logger.info('replied to comment {}'.format(comment.id))
-                    self.submissions_comment_counter[comment.link_id] += 1
+                    logger.info('replied to comment %s', comment.id)
+                    self.submissions_comment_counter.increment(comment.link_id)
                     self.did_post_in_subreddit(subreddit)
-                    self.subreddit_fullnames[subreddit] = comment.fullname
-                    break
+        self.subreddit_fullnames[listing] = latest
+
+    def _prefetch_parents(self, comments):
+        """Batch-fetch parent comments into the parent cache.
+
+        Walks the batch breadth-first, fetching each level of distinct
+        ancestors with a single `get_info` call instead of one HTTP
+        round trip per parent.
+        """
+        level = [c for c in comments if not c.is_root]
+        for _ in range(self._score_check_depth + 1):
+            wanted = {c.parent_id for c in level}
+            wanted.difference_update(self._parent_cache)
+            if not wanted:
+                break
+            parents = self.r.get_info(thing_id=list(wanted))
+            if not parents:
+                break
+            for parent in parents:
+                self._cache_parent(parent.fullname, parent)
+            level = [p for p in parents if not p.is_root]
+
+    def _cache_parent(self, fullname, parent):
+        cache = self._parent_cache
+        cache[fullname] = parent
+        if len(cache) > self.PARENT_CACHE_SIZE:
+            # dicts iterate in insertion order, drop the oldest entry
+            del cache[next(iter(cache))]
+
+    def refresh(self):
+        super(RedditCommentBot, self).refresh()
+        # drop cached parents and verdicts so score and blacklist
+        # decisions are re-evaluated against fresh data after a refresh
+        self._parent_cache.clear()
+        self._invalid_comments.clear()
+        # before markers are keyed by the combined listing path, which
+        # a changed whitelist invalidates; starting unfiltered also
+        # recovers from a marker whose comment was deleted
+        self.subreddit_fullnames.clear()
 
     def is_valid_comment(self, comment):
-        """Check if the comment is eligible for a reply."""
+        """Check if the comment is eligible for a reply.
+
+        Replaced with a compiled version of `comment_checks`
+        during `bot_start`.
+        """
         return all(check(comment) for check in self.comment_checks)
 
     def comment_is_new(self, comment):
         """Only reply to new comments."""
-        now = datetime.utcnow()
-        created = datetime.utcfromtimestamp(comment.created_utc)
-        delta = timedelta(seconds=self.settings['comment_max_age'])
-
-        return created + delta > now
+        return (time.time() - comment.created_utc) < self._max_age_seconds
 
     def comment_submission_cap_not_reached(self, comment):
-        max_replies = self.settings['max_replies_per_post']
+        return self.submissions_comment_counter.get(comment.link_id, 0) \
+            < self._max_replies
 
-        return self.submissions_comment_counter[comment.link_id] < max_replies
+    def _comment_author_name(self, comment):
+        """Author name without re-touching the lazy author object.
+
+        Accessing `comment.author.name` can make PRAW fetch
+        /user/X/about, so the name is remembered on the comment and
+        the parent-chain checks never look the same author up twice.
+        `None` marks a deleted author.
+        """
+        try:
+            return comment._cached_author_name
+        except AttributeError:
+            pass
+        author = comment.author
+        name = author.name if author else None
+        comment._cached_author_name = name
+        return name
 
     def comment_author_blacklisted(self, comment):
-        if not comment.author:
+        name = self._comment_author_name(comment)
+        if name is None:
             return True
 
-        return self.is_user_blocked(comment.author.name)
+        return self.is_user_blocked(name)
 
     def comment_author_not_blacklisted(self, comment):
         return not self.comment_author_blacklisted(comment)
 
     def comment_has_good_parents(self, comment, depth=0):
-        """Check the score and user of parent comments."""
-        logger.debug('comment_has_good_parents('
-                     'comment={!r}, depth={!r})'.format(comment.id, depth))
-        return not any(self._comment_has_good_parents(comment, depth))
-
-    def _comment_has_good_parents(self, comment, depth):
-        yield self.comment_author_blacklisted(comment)
-        yield comment.score_hidden and not self.settings['reply_if_score_hidden']
-        yield comment.score < self.settings['min_comment_score']
-        if comment.is_root or depth > self.settings['score_check_depth']:
-            return
-        yield not self.comment_has_good_parents(
-            self._comment_parent(comment), depth + 1)
+        """Check the score and user of the comment and its parents.
+
+        Walks the ancestor chain iteratively with an early exit; the
+        parents normally come out of the batch-prefetched cache.
+        """
+        logger.debug('comment_has_good_parents(comment=%r, depth=%r)',
+                     comment.id, depth)
+        while True:
+            if self.comment_author_blacklisted(comment):
+                return False
+            if comment.score_hidden and not self._reply_if_score_hidden:
+                return False
+            if comment.score < self._min_comment_score:
+                return False
+            if comment.is_root or depth > self._score_check_depth:
+                return True
+            comment = self._comment_parent(comment)
+            depth += 1
 
     def _comment_parent(self, comment):
-        return self.r.get_info(thing_id=comment.parent_id)
+        parent_id = comment.parent_id
+        parent = self._parent_cache.get(parent_id)
+        if parent is None:
+            parent = self.r.get_info(thing_id=parent_id)
+            self._cache_parent(parent_id, parent)
+        return parent
 
 
 class RedditSubmissionBot(_RedditReplyBotMixin, RedditBot):
@@ -211,26 +492,40 @@ class RedditSubmissionBot(_RedditReplyBotMixin, RedditBot):
     def loop(self, subreddit):
         super(RedditSubmissionBot, self).loop(subreddit)
 
-        if not self.can_post_in_subreddit(subreddit):
+        listing = self._combined_subreddits()
+        if not self._combined_fetch_due(listing):
             return
 
-        latest = self.subreddit_submissions.get(subreddit, None)
-        self.check_submissions(subreddit, before=latest)
+        latest = self.subreddit_submissions.get(listing, None)
+        self.check_submissions(listing, before=latest)
 
-    def check_submissions(self, subreddit, before=None):
-        """Fetch latest submissions in a subreddit."""
-        for control, thing in self._check_things('submissions', subreddit, before):
-            if control == 'end':
-                self.subreddit_submissions[subreddit] = thing
-                break
+    def check_submissions(self, listing, before=None):
+        """Fetch latest submissions from a (possibly combined) listing."""
+        found_new = False
+        for submission in self._check_things('submissions', listing, before):
+            if not found_new:
+                # first submission is the newest, remember it so the
+                # next poll starts there
+                self.subreddit_submissions[listing] = submission.fullname
+                found_new = True
 
-            submission = thing
+            subreddit = submission.subreddit.display_name
+            if not self.can_post_in_subreddit(subreddit):
+                continue
 
             if self.is_valid_submission(submission):
                 did_reply = self.reply_submission(submission)
                 if did_reply:
-                    logger.info('replied to submission: {}'.format(submission.id))
+                    logger.info('replied to submission: %s', submission.id)
                     self.did_post_in_subreddit(subreddit)
-                    self.subreddit_submissions[subreddit] = submission.fullname
-                    break
+
+        self.did_poll_subreddit(listing, found_new)
+        if self._before_marker_stale(listing, found_new):
+            self.subreddit_submissions.pop(listing, None)
+
+    def refresh(self):
+        super(RedditSubmissionBot, self).refresh()
+        # before markers are keyed by the combined listing path; see
+        # RedditCommentBot.refresh
+        self.subreddit_submissions.clear()
 
@@ -16,6 +16,7 @@ setup(
     package_dir={'reddit_bot': 'reddit_bot'},
     package_data={'reddit_bot': ['*.template']},
     install_requires=['praw>=3.3.0'],
+    extras_require={'http-cache': ['requests-cache']},
     entry_points={'console_scripts': [
         'run-reddit-bot = reddit_bot.main:run',
     ]},
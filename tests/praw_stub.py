@@ -0,0 +1,37 @@
+"""
+Minimal praw/requests stand-ins so the unit tests can import
+reddit_bot without the network-facing dependencies installed.
+
+Only the names reddit_bot imports at module level are provided; the
+tests drive the bot through stub objects of their own.
+
+"""
+import sys
+import types
+
+
+def install():
+    if 'praw' not in sys.modules:
+        praw = types.ModuleType('praw')
+        praw.Reddit = type('Reddit', (object,), {})
+
+        errors = types.ModuleType('praw.errors')
+        for name in ('Forbidden', 'RateLimitExceeded', 'HTTPException'):
+            setattr(errors, name, type(name, (Exception,), {}))
+        praw.errors = errors
+
+        handlers = types.ModuleType('praw.handlers')
+        handlers.DefaultHandler = type('DefaultHandler', (object,), {})
+        praw.handlers = handlers
+
+        sys.modules['praw'] = praw
+        sys.modules['praw.errors'] = errors
+        sys.modules['praw.handlers'] = handlers
+
+    if 'requests' not in sys.modules:
+        requests = types.ModuleType('requests')
+        exceptions = types.ModuleType('requests.exceptions')
+        exceptions.ConnectionError = type('ConnectionError', (Exception,), {})
+        requests.exceptions = exceptions
+        sys.modules['requests'] = requests
+        sys.modules['requests.exceptions'] = exceptions
@@ -0,0 +1,64 @@
+import unittest
+
+from . import praw_stub
+
+praw_stub.install()
+
+from reddit_bot.base import RedditBot  # noqa: E402
+
+
+class StubRedditor(object):
+    def __init__(self):
+        self.friend_calls = 0
+        self.unfriend_calls = 0
+
+    def friend(self):
+        self.friend_calls += 1
+
+    def unfriend(self):
+        self.unfriend_calls += 1
+
+
+class StubReddit(object):
+    def __init__(self):
+        self.redditors = {}
+
+    def get_redditor(self, name):
+        return self.redditors.setdefault(name, StubRedditor())
+
+
+def make_bot():
+    """A RedditBot with just the state the list mutators touch."""
+    bot = RedditBot.__new__(RedditBot)
+    bot.r = StubReddit()
+    bot.bot_name = 'test_bot'
+    bot.subreddit_shard = None
+    bot.subreddits = set()
+    bot.blocked_users = set()
+    # file-backed lists make the mutators skip the on-disk API cache
+    bot.subreddits_file = 'subreddits.txt'
+    bot.blocked_users_file = 'blocked.txt'
+    bot._rebuild_fast_lookups()
+    return bot
+
+
+class BlockUsersTest(unittest.TestCase):
+
+    def test_block_users_does_not_refriend(self):
+        bot = make_bot()
+        bot.block_users('spammer')
+        bot.block_users('spammer')
+        self.assertEqual(bot.r.get_redditor('spammer').friend_calls, 1)
+        self.assertTrue(bot.is_user_blocked('spammer'))
+
+    def test_unblock_users_does_not_unfriend_twice(self):
+        bot = make_bot()
+        bot.block_users('spammer')
+        bot.unblock_users('spammer')
+        bot.unblock_users('spammer')
+        self.assertEqual(bot.r.get_redditor('spammer').unfriend_calls, 1)
+        self.assertFalse(bot.is_user_blocked('spammer'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+from . import praw_stub
+
+praw_stub.install()
+
+from reddit_bot.reply_bot import RedditCommentBot  # noqa: E402
+
+
+class StubThing(object):
+    def __init__(self, fullname, parent_id=None):
+        self.fullname = fullname
+        self.parent_id = parent_id
+        self.is_root = parent_id is None
+
+
+class StubReddit(object):
+    def __init__(self, things):
+        self.things = {thing.fullname: thing for thing in things}
+        self.get_info_calls = 0
+
+    def get_info(self, thing_id):
+        self.get_info_calls += 1
+        if isinstance(thing_id, list):
+            return [self.things[fullname] for fullname in thing_id]
+        return self.things[thing_id]
+
+
+def make_bot(things):
+    """A RedditCommentBot with just the parent-cache state."""
+    bot = RedditCommentBot.__new__(RedditCommentBot)
+    bot.r = StubReddit(things)
+    bot._parent_cache = {}
+    bot._score_check_depth = 4
+    return bot
+
+
+class ParentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = StubThing('t1_root')
+        self.mid = StubThing('t1_mid', parent_id='t1_root')
+        self.c1 = StubThing('t1_c1', parent_id='t1_mid')
+        self.c2 = StubThing('t1_c2', parent_id='t1_mid')
+        self.bot = make_bot([self.root, self.mid, self.c1, self.c2])
+
+    def test_comment_parent_fetches_once(self):
+        self.assertIs(self.bot._comment_parent(self.c1), self.mid)
+        self.assertIs(self.bot._comment_parent(self.c1), self.mid)
+        self.assertIs(self.bot._comment_parent(self.c2), self.mid)
+        self.assertEqual(self.bot.r.get_info_calls, 1)
+
+    def test_prefetch_parents_one_call_per_level(self):
+        self.bot._prefetch_parents([self.c1, self.c2])
+        # the shared parent and the root: one batched call per level
+        self.assertEqual(self.bot.r.get_info_calls, 2)
+
+        # the parent walk is then served entirely from the cache
+        self.assertIs(self.bot._comment_parent(self.c1), self.mid)
+        self.assertIs(self.bot._comment_parent(self.mid), self.root)
+        self.assertEqual(self.bot.r.get_info_calls, 2)
+
+    def test_prefetch_parents_skips_root_comments(self):
+        self.bot._prefetch_parents([self.root])
+        self.assertEqual(self.bot.r.get_info_calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()